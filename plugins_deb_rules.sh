@@ -11,6 +11,9 @@ PROGNAME="${progname:-$(awk '/^Source/ {print $2}' debian/control)}"
 BUILDROOT="${buildroot:-"debian/$PROGNAME"}"
 TMP="${tmp:-debian/tmp}"
 TIMESTAMP="2025-01-01 00:00:00Z"
+# must match the queue and trigger handled in debian/$PROGNAME.postinst
+INSTALL_QUEUE="/var/lib/$PROGNAME/install-queue"
+INSTALL_TRIGGER="$PROGNAME-install-modules"
 
 for plugin in modules/* themes/*; do
 
@@ -28,7 +31,9 @@ for plugin in modules/* themes/*; do
 
     maint_script="debian/$PROGNAME-$plugin_name"
 
-    cat > "$maint_script.postinst" <<EOF
+    if [[ -e "debian/postinst.d/$plugin_name" ]]; then
+        # extra postinst steps may rely on the plugin, so install it straight away
+        cat > "$maint_script.postinst" <<EOF
 #!/bin/sh
 set -e
 
@@ -38,8 +43,20 @@ cd /usr/share/$PROGNAME
 
 #DEBHELPER#
 EOF
-    if [[ -e "debian/postinst.d/$plugin_name" ]]; then
         cat "debian/postinst.d/$plugin_name" >> "$maint_script.postinst"
+    else
+        # queue the archive, the $PROGNAME trigger handler installs all queued
+        # archives in one pass once dpkg has unpacked everything
+        cat > "$maint_script.postinst" <<EOF
+#!/bin/sh
+set -e
+
+mkdir -p $(dirname "$INSTALL_QUEUE")
+echo /usr/share/$PROGNAME/$plugin_dir/$plugin_tar_file >> $INSTALL_QUEUE
+dpkg-trigger $INSTALL_TRIGGER
+
+#DEBHELPER#
+EOF
     fi
     cat > "$maint_script.postrm" <<EOF
 #!/bin/sh
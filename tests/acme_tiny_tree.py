@@ -0,0 +1,63 @@
+"""Build and load acme_tiny.py as shipped in the Debian package, that is
+with the debian/patches/acme-tiny-* patches applied, or as upstream ships
+it, for comparison.
+"""
+import importlib.util, os, shutil, subprocess, tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOURCES = ["webmin_core/webmin/acme_tiny.py", "webmin_core/webmin/letsencrypt-lib.pl"]
+
+def _acme_patches():
+    with open(os.path.join(ROOT, "debian", "patches", "series")) as series:
+        return [line.strip() for line in series if line.startswith("acme-tiny-")]
+
+def build(dest, patched=True):
+    """Copy the acme_tiny sources into dest with the patches applied (or not),
+    whether or not quilt has already applied them to this tree, and return
+    the path of acme_tiny.py"""
+    applied_path = os.path.join(ROOT, ".pc", "applied-patches")
+    applied = []
+    if os.path.exists(applied_path):
+        with open(applied_path) as applied_file:
+            applied = [line.strip() for line in applied_file if line.startswith("acme-tiny-")]
+    for source in SOURCES:
+        if not os.path.isdir(os.path.join(dest, os.path.dirname(source))):
+            os.makedirs(os.path.join(dest, os.path.dirname(source)))
+        shutil.copy(os.path.join(ROOT, source), os.path.join(dest, source))
+    if patched:
+        steps = [(patch, []) for patch in _acme_patches() if patch not in applied]
+    else:
+        steps = [(patch, ["-R"]) for patch in reversed(applied)]
+    for patch, flags in steps:
+        with open(os.path.join(ROOT, "debian", "patches", patch)) as patch_file:
+            subprocess.check_call(["patch", "-s", "-p1", "--no-backup-if-mismatch"] + flags, cwd=dest, stdin=patch_file)
+    return os.path.join(dest, SOURCES[0])
+
+def load(path, name="acme_tiny"):
+    """Import acme_tiny.py from path as a fresh module"""
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def load_patched():
+    """Build the patched acme_tiny.py in a temporary directory and import it,
+    returns (module, directory) - remove the directory when done"""
+    tmp = tempfile.mkdtemp(prefix="acme-tiny-")
+    return load(build(tmp)), tmp
+
+def make_key(path, kind="rsa"):
+    """Generate an account or domain key, kind is rsa, rsa4096, P-256 or P-384"""
+    if kind.startswith("rsa"):
+        args = ["-algorithm", "RSA", "-pkeyopt", "rsa_keygen_bits:{0}".format(kind[3:] or 2048)]
+    else:
+        args = ["-algorithm", "EC", "-pkeyopt", "ec_paramgen_curve:" + kind]
+    subprocess.check_call(["openssl", "genpkey"] + args + ["-out", path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return path
+
+def make_csr(path, key, domains):
+    """Generate a csr for domains, the first is also the common name"""
+    subprocess.check_call(["openssl", "req", "-new", "-key", key, "-subj", "/CN=" + domains[0],
+                           "-addext", "subjectAltName=" + ",".join("DNS:" + domain for domain in domains), "-out", path],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return path
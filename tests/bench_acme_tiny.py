@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""Benchmark acme_tiny.py issuance against the fake ACME CA
+
+Issues one certificate for 1, 10 and 100 domain orders with upstream's
+acme_tiny.py and with the Debian patches applied (with and without a warm
+--cache-dir), and reports requests, connections, forks and wall time per
+order. --signing instead times a signed request for each supported account
+key type.
+
+    python3 tests/bench_acme_tiny.py [--latency SECONDS] [--domains 1,10,100]
+    python3 tests/bench_acme_tiny.py --signing [--count N]
+"""
+import argparse, json, logging, os, shutil, subprocess, sys, tempfile, threading, time
+
+import acme_tiny_tree
+from fake_acme import FakeACME
+
+LOG = logging.getLogger("acme_tiny.bench")
+LOG.addHandler(logging.NullHandler())
+LOG.propagate = False
+
+class ForkCounter(object):
+    """Count subprocess.Popen calls made by the benchmarking thread only,
+    so the fake CA signing certificates doesn't count"""
+
+    def __init__(self):
+        self.forks, self.thread, self.popen = 0, threading.current_thread(), subprocess.Popen
+        counter = self
+        class CountingPopen(subprocess.Popen):
+            def __init__(self, *args, **kwargs):
+                if threading.current_thread() is counter.thread:
+                    counter.forks += 1
+                counter.popen.__init__(self, *args, **kwargs)
+        subprocess.Popen = CountingPopen
+
+    def restore(self):
+        subprocess.Popen = self.popen
+
+def bench_issuance(args, tmp):
+    variants = [("upstream", acme_tiny_tree.load(acme_tiny_tree.build(os.path.join(tmp, "upstream"), patched=False), "acme_tiny_upstream"), {})]
+    patched = acme_tiny_tree.load(acme_tiny_tree.build(os.path.join(tmp, "patched")), "acme_tiny_patched")
+    variants.append(("patched", patched, {}))
+    variants.append(("patched, cached", patched, {"cache_dir": os.path.join(tmp, "cache")}))
+    account_key = acme_tiny_tree.make_key(os.path.join(tmp, "account.key"), args.key_type)
+    domain_key = acme_tiny_tree.make_key(os.path.join(tmp, "domain.key"))
+    acme_dir = os.path.join(tmp, "challenges")
+    os.mkdir(acme_dir)
+    print("{0:>7}  {1:<16} {2:>8} {3:>11} {4:>5} {5:>8}".format("domains", "acme_tiny", "requests", "connections", "forks", "seconds"))
+    with FakeACME(acme_dir, latency=args.latency) as ca:
+        for count in [int(n) for n in args.domains.split(",")]:
+            csr = acme_tiny_tree.make_csr(os.path.join(tmp, "{0}.csr".format(count)), domain_key,
+                                          ["d{0}.example.com".format(i) for i in range(count)])
+            for name, module, kwargs in variants:
+                if "cache_dir" in kwargs and not os.path.isdir(kwargs['cache_dir']):
+                    module.get_crt(account_key, csr, acme_dir, log=LOG, disable_check=True, directory_url=ca.directory_url, **kwargs)
+                ca.reset_counts()
+                counter = ForkCounter()
+                start = time.time()
+                try:
+                    module.get_crt(account_key, csr, acme_dir, log=LOG, disable_check=True, directory_url=ca.directory_url, **kwargs)
+                finally:
+                    counter.restore()
+                print("{0:>7}  {1:<16} {2:>8} {3:>11} {4:>5} {5:>8.2f}".format(count, name, ca.requests, ca.connections, counter.forks, time.time() - start))
+
+def bench_signing(args, tmp):
+    acme_tiny = acme_tiny_tree.load(acme_tiny_tree.build(os.path.join(tmp, "patched")))
+    acme_dir = os.path.join(tmp, "challenges")
+    os.mkdir(acme_dir)
+    print("{0:<8} {1:<6} {2:>16} {3:>16}".format("key", "alg", "ms per request", "signature chars"))
+    with FakeACME(acme_dir) as ca:
+        for key_type in ("rsa", "rsa4096", "P-256", "P-384"):
+            account_key = acme_tiny_tree.make_key(os.path.join(tmp, key_type + ".key"), key_type)
+            session = acme_tiny.get_session(account_key, log=LOG, directory_url=ca.directory_url)
+            start = time.time()
+            for _ in range(args.count):
+                acme_tiny._send_signed_request(session, session['kid'], None, "Error")
+            seconds = (time.time() - start) / args.count
+            # size of the signature in a sample JWS, as sent to the CA
+            sent = []
+            do_request = acme_tiny._do_request
+            acme_tiny._do_request = lambda session, url, data=None, **kwargs: sent.append(data) or do_request(session, url, data=data, **kwargs)
+            try:
+                acme_tiny._send_signed_request(session, session['kid'], None, "Error")
+            finally:
+                acme_tiny._do_request = do_request
+            print("{0:<8} {1:<6} {2:>16.1f} {3:>16}".format(key_type, session['alg'], seconds * 1000, len(json.loads(sent[-1].decode('utf8'))['signature'])))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark acme_tiny.py against the fake ACME CA")
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds of latency added to every request, default 0.01")
+    parser.add_argument("--domains", default="1,10,100", help="comma separated domain counts to order, default 1,10,100")
+    parser.add_argument("--key-type", default="rsa", help="account key type for issuance: rsa, rsa4096, P-256 or P-384, default rsa")
+    parser.add_argument("--signing", action="store_true", help="time signed requests per account key type instead")
+    parser.add_argument("--count", type=int, default=50, help="signed requests per key type with --signing, default 50")
+    args = parser.parse_args(argv)
+    for name in ("http_proxy", "HTTP_PROXY"):
+        os.environ.pop(name, None)
+    tmp = tempfile.mkdtemp(prefix="acme-tiny-bench-")
+    try:
+        (bench_signing if args.signing else bench_issuance)(args, tmp)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
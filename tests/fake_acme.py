@@ -0,0 +1,224 @@
+"""In-process stand-in for an ACME (RFC 8555) CA, for testing and
+benchmarking acme_tiny.py without network access or rate limits.
+
+It implements just what acme_tiny uses: the directory, nonces, accounts,
+orders, http-01 challenges (checked against the challenge file acme_tiny
+writes), finalize and certificate download. Request latency and badNonce
+rejections can be injected, and requests, connections and account
+registrations are counted.
+"""
+import base64, hashlib, itertools, json, os, shutil, socket, subprocess, tempfile, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ERROR = "urn:ietf:params:acme:error:"
+
+def b64decode(s):
+    return base64.urlsafe_b64decode(s + "=" * (-len(s) % 4))
+
+def thumbprint(jwk):
+    jwk_json = json.dumps(jwk, sort_keys=True, separators=(',', ':'))
+    return base64.urlsafe_b64encode(hashlib.sha256(jwk_json.encode('utf8')).digest()).decode('utf8').rstrip("=")
+
+class FakeACME(object):
+    """An ACME CA on a local port, start() it and pass directory_url to
+    acme_tiny. Challenge files are read from challenge_dir rather than
+    fetched over http, so run acme_tiny with disable_check.
+    """
+
+    def __init__(self, challenge_dir, latency=0, cert_days=90):
+        self.challenge_dir = challenge_dir
+        self.latency = latency # seconds added to every request
+        self.cert_days = cert_days
+        self.bad_nonces = 0 # reject this many of the next signed requests with badNonce
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.nonces = set()
+        self.accounts = {} # account url: jwk
+        self.orders, self.authzs = {}, {}
+        self.certs = {}
+        self.reset_counts()
+        self.tmp = tempfile.mkdtemp(prefix="fake-acme-")
+        self.ca_key, self.ca_crt = os.path.join(self.tmp, "ca.key"), os.path.join(self.tmp, "ca.crt")
+        subprocess.check_call(["openssl", "req", "-x509", "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:P-256", "-nodes",
+                               "-subj", "/CN=Fake ACME CA", "-days", "3650", "-keyout", self.ca_key, "-out", self.ca_crt],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.server = None
+
+    def reset_counts(self):
+        self.requests = self.connections = self.registrations = 0
+        self.paths = {}
+
+    def reset_accounts(self):
+        """Forget every account, as after a deactivation or a staging reset"""
+        with self.lock:
+            self.accounts.clear()
+
+    def start(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _handler(self))
+        self.server.daemon_threads = True
+        self.url = "http://127.0.0.1:{0}".format(self.server.server_address[1])
+        self.directory_url = self.url + "/directory"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def new_nonce(self):
+        nonce = base64.urlsafe_b64encode(os.urandom(12)).decode('utf8')
+        with self.lock:
+            self.nonces.add(nonce)
+        return nonce
+
+    def use_nonce(self, nonce):
+        with self.lock:
+            if self.bad_nonces > 0:
+                self.bad_nonces -= 1
+                return False
+            if nonce not in self.nonces:
+                return False
+            self.nonces.remove(nonce)
+            return True
+
+    def sign(self, csr_der):
+        """Issue a certificate for a DER csr, returns the PEM chain"""
+        csr_pem = "-----BEGIN CERTIFICATE REQUEST-----\n{0}\n-----END CERTIFICATE REQUEST-----\n".format(base64.encodebytes(csr_der).decode('utf8').strip())
+        proc = subprocess.Popen(["openssl", "x509", "-req", "-CA", self.ca_crt, "-CAkey", self.ca_key, "-set_serial", str(next(self.ids)),
+                                 "-days", str(self.cert_days), "-copy_extensions", "copy"],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate(csr_pem.encode('utf8'))
+        if proc.returncode != 0:
+            raise ValueError(err.decode('utf8'))
+        with open(self.ca_crt) as ca_file:
+            return out.decode('utf8') + ca_file.read()
+
+def _handler(ca):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def setup(self):
+            BaseHTTPRequestHandler.setup(self)
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with ca.lock:
+                ca.connections += 1
+
+        def handle_one_request(self):
+            if ca.latency:
+                time.sleep(ca.latency)
+            BaseHTTPRequestHandler.handle_one_request(self)
+
+        def reply(self, code, body, headers=None, content_type="application/json"):
+            data = body if isinstance(body, bytes) else json.dumps(body).encode('utf8')
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.send_header("Replay-Nonce", ca.new_nonce())
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(data)
+
+        def problem(self, code, error, detail):
+            self.reply(code, {"type": ERROR + error, "detail": detail}, content_type="application/problem+json")
+
+        def count(self):
+            with ca.lock:
+                ca.requests += 1
+                kind = self.path.split("/")[1]
+                ca.paths[kind] = ca.paths.get(kind, 0) + 1
+
+        def do_HEAD(self):
+            self.do_GET()
+
+        def do_GET(self):
+            self.count()
+            if self.path == "/directory":
+                return self.reply(200, {"newNonce": ca.url + "/new-nonce", "newAccount": ca.url + "/new-account", "newOrder": ca.url + "/new-order"})
+            if self.path == "/new-nonce":
+                return self.reply(200, b"", content_type="text/plain")
+            self.problem(404, "malformed", "not found")
+
+        def do_POST(self):
+            self.count()
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])).decode('utf8'))
+            protected = json.loads(b64decode(body['protected']).decode('utf8'))
+            payload = json.loads(b64decode(body['payload']).decode('utf8')) if body['payload'] else None
+            if not ca.use_nonce(protected.get('nonce')):
+                return self.problem(400, "badNonce", "bad nonce")
+            if protected.get('url') != ca.url + self.path:
+                return self.problem(400, "unauthorized", "url mismatch")
+
+            # accounts are looked up by key on newAccount, and by account url (kid) everywhere else
+            if self.path == "/new-account":
+                if "jwk" not in protected:
+                    return self.problem(400, "malformed", "newAccount must be signed with a jwk")
+                with ca.lock:
+                    kid = [url for url, jwk in ca.accounts.items() if jwk == protected['jwk']]
+                    if not kid:
+                        kid = [ca.url + "/account/{0}".format(next(ca.ids))]
+                        ca.accounts[kid[0]] = protected['jwk']
+                        ca.registrations += 1
+                        code = 201
+                    else:
+                        code = 200
+                return self.reply(code, {"status": "valid", "contact": (payload or {}).get('contact', [])}, {"Location": kid[0]})
+            jwk = ca.accounts.get(protected.get('kid'))
+            if jwk is None:
+                return self.problem(400, "accountDoesNotExist", "no account {0}".format(protected.get('kid')))
+
+            kind, _, key = self.path[1:].partition("/")
+            if kind == "account":
+                return self.reply(200, {"status": "valid", "contact": (payload or {}).get('contact', [])})
+            if kind == "new-order":
+                order_id = next(ca.ids)
+                order = {"status": "pending", "identifiers": payload['identifiers'], "authorizations": [],
+                         "finalize": ca.url + "/finalize/{0}".format(order_id)}
+                for identifier in payload['identifiers']:
+                    authz_id = str(next(ca.ids))
+                    ca.authzs[authz_id] = {"status": "pending", "identifier": identifier, "challenges": [
+                        {"type": "http-01", "status": "pending", "url": ca.url + "/challenge/" + authz_id, "token": "token-" + authz_id}]}
+                    order['authorizations'].append(ca.url + "/authz/" + authz_id)
+                ca.orders[str(order_id)] = order
+                return self.reply(201, order, {"Location": ca.url + "/order/{0}".format(order_id)})
+            if kind == "authz" and key in ca.authzs:
+                return self.reply(200, ca.authzs[key])
+            if kind == "challenge" and key in ca.authzs:
+                authz = ca.authzs[key]
+                challenge = authz['challenges'][0]
+                try:
+                    with open(os.path.join(ca.challenge_dir, challenge['token'])) as challenge_file:
+                        valid = challenge_file.read() == "{0}.{1}".format(challenge['token'], thumbprint(jwk))
+                except IOError:
+                    valid = False
+                challenge['status'] = authz['status'] = "valid" if valid else "invalid"
+                return self.reply(200, challenge)
+            if kind in ("order", "finalize") and key in ca.orders:
+                order = ca.orders[key]
+                if order['status'] == "pending" and all(ca.authzs[url.rsplit("/", 1)[1]]['status'] == "valid" for url in order['authorizations']):
+                    order['status'] = "ready"
+                if kind == "finalize":
+                    if order['status'] != "ready":
+                        return self.problem(403, "orderNotReady", "order is {0}".format(order['status']))
+                    try:
+                        ca.certs[key] = ca.sign(b64decode(payload['csr']))
+                    except ValueError as e:
+                        return self.problem(400, "badCSR", str(e))
+                    order['status'], order['certificate'] = "valid", ca.url + "/cert/" + key
+                return self.reply(200, order)
+            if kind == "cert" and key in ca.certs:
+                return self.reply(200, ca.certs[key].encode('utf8'), content_type="application/pem-certificate-chain")
+            self.problem(404, "malformed", "not found")
+    return Handler
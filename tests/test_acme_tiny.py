@@ -0,0 +1,292 @@
+"""End to end tests of the patched acme_tiny.py against the fake ACME CA"""
+import logging, os, shutil, subprocess, tempfile, time, unittest
+from unittest import mock
+
+import acme_tiny_tree
+from fake_acme import FakeACME
+
+LOG = logging.getLogger("acme_tiny.test")
+LOG.addHandler(logging.NullHandler())
+LOG.propagate = False
+
+def setUpModule():
+    global acme_tiny, build_dir, keys_dir, account_key, domain_key
+    acme_tiny, build_dir = acme_tiny_tree.load_patched()
+    keys_dir = tempfile.mkdtemp(prefix="acme-tiny-keys-")
+    account_key = acme_tiny_tree.make_key(os.path.join(keys_dir, "account.key"))
+    domain_key = acme_tiny_tree.make_key(os.path.join(keys_dir, "domain.key"))
+
+def tearDownModule():
+    shutil.rmtree(build_dir, ignore_errors=True)
+    shutil.rmtree(keys_dir, ignore_errors=True)
+
+def cert_domains(pem):
+    """Return the SAN DNS names of the first certificate in a PEM chain"""
+    proc = subprocess.Popen(["openssl", "x509", "-noout", "-ext", "subjectAltName"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    out = proc.communicate(pem.encode('utf8'))[0].decode('utf8')
+    return sorted(name.strip()[4:] for name in out.splitlines()[1].split(","))
+
+class AcmeTinyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="acme-tiny-test-")
+        self.acme_dir = os.path.join(self.tmp, "challenges")
+        self.cache_dir = os.path.join(self.tmp, "cache")
+        os.mkdir(self.acme_dir)
+        self.ca = FakeACME(self.acme_dir).start()
+        # keep-alive requests bypass the pool if a proxy is configured
+        proxies = mock.patch.dict(os.environ, dict((name, "") for name in ("http_proxy", "HTTP_PROXY", "https_proxy", "HTTPS_PROXY")))
+        proxies.start()
+        self.addCleanup(proxies.stop)
+
+    def tearDown(self):
+        self.ca.stop()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def csr(self, domains, name="domain"):
+        return acme_tiny_tree.make_csr(os.path.join(self.tmp, name + ".csr"), domain_key, domains)
+
+    def get_crt(self, csr, **kwargs):
+        kwargs.setdefault("log", LOG)
+        return acme_tiny.get_crt(account_key, csr, self.acme_dir, disable_check=True, directory_url=self.ca.directory_url, **kwargs)
+
+    def get_crts(self, jobs, **kwargs):
+        return acme_tiny.get_crts(account_key, jobs, self.acme_dir, log=LOG, disable_check=True, directory_url=self.ca.directory_url, **kwargs)
+
+class GetCrtTest(AcmeTinyTestCase):
+
+    def test_issues_certificate_for_csr_domains(self):
+        stats = {}
+        pem = self.get_crt(self.csr(["example.com", "www.example.com"]), stats=stats)
+        self.assertEqual(cert_domains(pem), ["example.com", "www.example.com"])
+        self.assertEqual(os.listdir(self.acme_dir), [])
+        self.assertEqual(stats['requests'], self.ca.requests)
+
+    def test_one_connection_and_no_nonce_requests(self):
+        self.get_crt(self.csr(["example.com", "www.example.com"]))
+        self.assertEqual(self.ca.connections, 1)
+        self.assertNotIn("new-nonce", self.ca.paths) # every reply carries the next nonce
+
+    def test_bad_nonces_are_retried(self):
+        self.ca.bad_nonces = 3
+        stats = {}
+        self.get_crt(self.csr(["example.com"]), stats=stats)
+        self.assertEqual(self.ca.bad_nonces, 0)
+        self.assertEqual(stats['requests'], self.ca.requests)
+
+    def test_failed_challenge(self):
+        session = acme_tiny.get_session(account_key, log=LOG, directory_url=self.ca.directory_url)
+        session['thumbprint'] = "wrong"
+        with self.assertRaisesRegex(ValueError, "Challenge did not pass for example.com"):
+            self.get_crt(self.csr(["example.com"]), session=session)
+
+class AccountCacheTest(AcmeTinyTestCase):
+
+    def test_cached_account_skips_registration(self):
+        csr = self.csr(["example.com"])
+        self.get_crt(csr, cache_dir=self.cache_dir)
+        self.ca.reset_counts()
+        self.get_crt(csr, cache_dir=self.cache_dir)
+        self.assertNotIn("new-account", self.ca.paths)
+        self.assertNotIn("directory", self.ca.paths)
+
+    def test_expired_cache_registers_again(self):
+        csr = self.csr(["example.com"])
+        self.get_crt(csr, cache_dir=self.cache_dir)
+        self.ca.reset_counts()
+        self.get_crt(csr, cache_dir=self.cache_dir, cache_ttl=-1)
+        self.assertEqual(self.ca.paths.get("new-account"), 1)
+
+    def test_rejected_cached_account_registers_again(self):
+        csr = self.csr(["example.com"])
+        self.get_crt(csr, cache_dir=self.cache_dir)
+        self.ca.reset_accounts()
+        self.ca.reset_counts()
+        self.get_crt(csr, cache_dir=self.cache_dir)
+        self.assertEqual(self.ca.registrations, 1)
+        # the new account url is cached for the next run
+        self.ca.reset_counts()
+        self.get_crt(csr, cache_dir=self.cache_dir)
+        self.assertEqual(self.ca.registrations, 0)
+        self.assertNotIn("new-account", self.ca.paths)
+
+    def test_rejected_account_without_cache_is_an_error(self):
+        session = acme_tiny.get_session(account_key, log=LOG, directory_url=self.ca.directory_url)
+        self.ca.reset_accounts()
+        self.ca.reset_counts()
+        with self.assertRaisesRegex(ValueError, "accountDoesNotExist"):
+            self.get_crt(self.csr(["example.com"]), session=session)
+        self.assertEqual(self.ca.registrations, 0)
+
+class ResumeTest(AcmeTinyTestCase):
+
+    def interrupt_after(self, path):
+        """Make signed requests to urls containing path raise KeyboardInterrupt once they got their reply"""
+        send = acme_tiny._send_signed_request
+        def interrupted(session, url, *args, **kwargs):
+            reply = send(session, url, *args, **kwargs)
+            if path in url:
+                raise KeyboardInterrupt(url)
+            return reply
+        return mock.patch.object(acme_tiny, "_send_signed_request", interrupted)
+
+    def test_resume_after_authorization(self):
+        csr = self.csr(["a.example.com", "b.example.com"])
+        with self.interrupt_after("/challenge/"), self.assertRaises(KeyboardInterrupt):
+            self.get_crt(csr, cache_dir=self.cache_dir)
+        self.ca.reset_counts()
+        self.get_crt(csr, cache_dir=self.cache_dir)
+        self.assertNotIn("new-order", self.ca.paths)
+        self.assertEqual([f for f in os.listdir(self.cache_dir) if f.startswith("order-")], [])
+
+    def test_resume_after_finalize(self):
+        csr = self.csr(["example.com"])
+        with self.interrupt_after("/finalize/"), self.assertRaises(KeyboardInterrupt):
+            self.get_crt(csr, cache_dir=self.cache_dir)
+        self.ca.reset_counts()
+        self.get_crt(csr, cache_dir=self.cache_dir)
+        self.assertEqual(self.ca.paths, {"new-nonce": 1, "order": 1, "cert": 1})
+
+    def test_finalized_order_not_reused_for_other_csr(self):
+        with self.interrupt_after("/finalize/"), self.assertRaises(KeyboardInterrupt):
+            self.get_crt(self.csr(["example.com"]), cache_dir=self.cache_dir)
+        other_key = acme_tiny_tree.make_key(os.path.join(self.tmp, "other.key"))
+        other_csr = acme_tiny_tree.make_csr(os.path.join(self.tmp, "other.csr"), other_key, ["example.com"])
+        self.ca.reset_counts()
+        self.get_crt(other_csr, cache_dir=self.cache_dir)
+        self.assertEqual(self.ca.paths.get("new-order"), 1)
+
+class BatchTest(AcmeTinyTestCase):
+
+    def test_batch_shares_one_session(self):
+        jobs = [(self.csr(["h{0}.example.com".format(i)], "h{0}".format(i)), os.path.join(self.tmp, "h{0}.crt".format(i))) for i in range(6)]
+        stats = {}
+        results = self.get_crts(jobs, max_jobs=3, stats=stats)
+        self.assertEqual(results, [(csr, crt, None) for csr, crt in jobs])
+        for i, (csr, crt) in enumerate(jobs):
+            with open(crt) as crt_file:
+                self.assertEqual(cert_domains(crt_file.read()), ["h{0}.example.com".format(i)])
+        self.assertEqual(self.ca.paths.get("new-account"), 1)
+        self.assertEqual(self.ca.paths.get("directory"), 1)
+        self.assertLessEqual(self.ca.connections, 4) # session setup, then one per worker
+        self.assertEqual(stats['requests'], self.ca.requests)
+
+    def test_failed_job_does_not_stop_batch(self):
+        good = (self.csr(["example.com"]), os.path.join(self.tmp, "good.crt"))
+        bad = (os.path.join(self.tmp, "missing.csr"), os.path.join(self.tmp, "bad.crt"))
+        results = self.get_crts([bad, good], max_jobs=1)
+        self.assertIsInstance(results[0][2], IOError)
+        self.assertIsNone(results[1][2])
+        self.assertFalse(os.path.exists(bad[1]))
+        self.assertTrue(os.path.exists(good[1]))
+
+    def test_same_domains_keep_separate_checkpoints(self):
+        jobs = []
+        for i in range(4):
+            key = acme_tiny_tree.make_key(os.path.join(self.tmp, "k{0}.key".format(i)))
+            csr = acme_tiny_tree.make_csr(os.path.join(self.tmp, "k{0}.csr".format(i)), key, ["example.com"])
+            jobs.append((csr, os.path.join(self.tmp, "k{0}.crt".format(i))))
+        self.ca.latency = 0.005
+        results = self.get_crts(jobs, max_jobs=4, cache_dir=self.cache_dir)
+        self.assertEqual([error for _, _, error in results], [None] * 4)
+        self.assertEqual(self.ca.paths.get("new-order"), 4)
+        self.assertEqual([f for f in os.listdir(self.cache_dir) if not f.startswith("account-")], [])
+
+class PlanRenewalsTest(AcmeTinyTestCase):
+
+    def setUp(self):
+        AcmeTinyTestCase.setUp(self)
+        self.csr_path = self.csr(["example.com"])
+        self.crt_path = os.path.join(self.tmp, "domain.crt")
+        with open(self.crt_path, "w") as crt_file:
+            crt_file.write(self.get_crt(self.csr_path))
+        past = time.time() - 60
+        os.utime(self.csr_path, (past, past))
+        self.not_after = acme_tiny._cert_expiry(self.crt_path, {})
+
+    def plan(self, renew_days, now, **kwargs):
+        return acme_tiny.plan_renewals([(self.csr_path, self.crt_path)], renew_days, log=LOG, now=now, **kwargs)
+
+    def test_due_inside_window(self):
+        self.assertEqual(self.plan(30, self.not_after - 31 * 86400), ([], [(self.csr_path, self.crt_path)]))
+        self.assertEqual(self.plan(30, self.not_after - 29 * 86400), ([(self.csr_path, self.crt_path)], []))
+
+    def test_missing_certificate_is_due(self):
+        os.remove(self.crt_path)
+        self.assertEqual(self.plan(30, time.time())[0], [(self.csr_path, self.crt_path)])
+
+    def test_expired_certificate_is_due(self):
+        for spread in (0, 15):
+            self.assertEqual(self.plan(30, self.not_after + 1, spread_days=spread)[0], [(self.csr_path, self.crt_path)])
+
+    def test_spread_keeps_half_the_window(self):
+        # offsets depend on the output path, so check a spread of certificates, even with a spread as wide as the window
+        jobs = []
+        for i in range(40):
+            jobs.append((self.csr_path, os.path.join(self.tmp, "spread{0}.crt".format(i))))
+            shutil.copy(self.crt_path, jobs[-1][1])
+        for spread in (15, 30):
+            due, not_due = acme_tiny.plan_renewals(jobs, 30, log=LOG, spread_days=spread, now=self.not_after - 15 * 86400)
+            self.assertEqual((sorted(due), not_due), (sorted(jobs), []))
+            due, not_due = acme_tiny.plan_renewals(jobs, 30, log=LOG, spread_days=spread, now=self.not_after - 29 * 86400)
+            self.assertTrue(due and not_due) # spread out above the cap
+
+    def test_changed_csr_is_due(self):
+        now = self.not_after - 60 * 86400
+        self.assertEqual(self.plan(30, now, cache_dir=self.cache_dir)[0], [])
+        future = time.time() + 60
+        os.utime(self.csr_path, (future, future))
+        self.assertEqual(self.plan(30, now, cache_dir=self.cache_dir)[0], [(self.csr_path, self.crt_path)])
+
+    def test_max_renewals_renews_soonest_first(self):
+        jobs = [(self.csr_path, os.path.join(self.tmp, "missing.crt")), (self.csr_path, self.crt_path)]
+        due, not_due = acme_tiny.plan_renewals(jobs, 30, log=LOG, max_renewals=1, now=self.not_after - 86400)
+        self.assertEqual(due, [jobs[0]])
+        self.assertEqual(not_due, [jobs[1]])
+
+class MainTest(AcmeTinyTestCase):
+
+    def main(self, *args):
+        level = acme_tiny.LOGGER.level
+        self.addCleanup(acme_tiny.LOGGER.setLevel, level)
+        acme_tiny.main(["--account-key", account_key, "--acme-dir", self.acme_dir, "--disable-check", "--quiet",
+                        "--directory-url", self.ca.directory_url] + list(args))
+
+    def assertUsageError(self, *args):
+        with mock.patch("sys.stderr"), self.assertRaises(SystemExit) as raised:
+            self.main(*args)
+        self.assertEqual(raised.exception.code, 2)
+
+    def test_batch_only_options_rejected_with_csr(self):
+        csr = self.csr(["example.com"])
+        for option in (["--batch", csr, "x.crt"], ["--batch-dir", self.tmp], ["--jobs", "2"], ["--renew-days", "30"],
+                       ["--renew-spread", "1"], ["--max-renewals", "1"]):
+            self.assertUsageError("--csr", csr, *option)
+
+    def test_spread_larger_than_window_rejected(self):
+        self.assertUsageError("--batch-dir", self.tmp, "--renew-days", "30", "--renew-spread", "60")
+        self.assertUsageError("--batch-dir", self.tmp, "--renew-days", "30", "--renew-spread", "16")
+        self.assertUsageError("--batch-dir", self.tmp, "--renew-spread", "1")
+
+    def test_batch_dir(self):
+        self.csr(["a.example.com"], "a")
+        self.csr(["b.example.com"], "b")
+        self.main("--batch-dir", self.tmp, "--renew-days", "30", "--cache-dir", self.cache_dir)
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, "a.crt")))
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, "b.crt")))
+        # nothing is due on the next run
+        self.ca.reset_counts()
+        self.main("--batch-dir", self.tmp, "--renew-days", "30", "--cache-dir", self.cache_dir)
+        self.assertEqual(self.ca.requests, 0)
+
+    def test_max_renewals_without_renew_days_renews_soonest_first(self):
+        self.csr(["a.example.com"], "a")
+        self.csr(["b.example.com"], "b")
+        self.main("--batch-dir", self.tmp, "--max-renewals", "1")
+        self.assertEqual(sorted(f for f in os.listdir(self.tmp) if f.endswith(".crt")), ["a.crt"])
+        # b.crt is missing, so b.csr goes before a.csr although it comes second
+        self.main("--batch-dir", self.tmp, "--max-renewals", "1")
+        self.assertEqual(sorted(f for f in os.listdir(self.tmp) if f.endswith(".crt")), ["a.crt", "b.crt"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+"""Check the patched acme_tiny.py's in-process CSR parsing against the
+openssl text scraping upstream acme_tiny.py does, on generated and on
+randomly mutated CSRs"""
+import base64, os, random, re, shutil, subprocess, tempfile, unittest
+
+import acme_tiny_tree
+
+def setUpModule():
+    global acme_tiny, build_dir, keys
+    acme_tiny, build_dir = acme_tiny_tree.load_patched()
+    keys = [acme_tiny_tree.make_key(os.path.join(build_dir, "rsa.key")), acme_tiny_tree.make_key(os.path.join(build_dir, "ec.key"), "P-256")]
+
+def tearDownModule():
+    shutil.rmtree(build_dir, ignore_errors=True)
+
+def upstream_parse_csr(csr):
+    """Find the domains and DER of a csr as upstream acme_tiny.py's get_crt does"""
+    out = subprocess.check_output(["openssl", "req", "-in", csr, "-noout", "-text"], stderr=subprocess.DEVNULL)
+    domains = set([])
+    common_name = re.search(r"Subject:.*? CN\s?=\s?([^\s,;/]+)", out.decode('utf8'))
+    if common_name is not None:
+        domains.add(common_name.group(1))
+    subject_alt_names = re.search(r"X509v3 Subject Alternative Name: (?:critical)?\n +([^\n]+)\n", out.decode('utf8'), re.MULTILINE|re.DOTALL)
+    if subject_alt_names is not None:
+        for san in subject_alt_names.group(1).split(", "):
+            if san.startswith("DNS:"):
+                domains.add(san[4:])
+    return domains, subprocess.check_output(["openssl", "req", "-in", csr, "-outform", "DER"], stderr=subprocess.DEVNULL)
+
+class CsrTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="acme-tiny-csr-")
+        self.path = os.path.join(self.tmp, "domain.csr")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def make_csr(self, subject, *extensions, **kwargs):
+        args = ["openssl", "req", "-new", "-key", kwargs.get("key", keys[0]), "-subj", subject, "-out", self.path]
+        for extension in extensions:
+            args += ["-addext", extension]
+        return subprocess.call(args + kwargs.get("extra", []), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+
+    def assertParsedLikeUpstream(self):
+        domains, der = acme_tiny._parse_csr(self.path)
+        self.assertEqual((domains, der), upstream_parse_csr(self.path))
+        return domains
+
+class CompatTest(CsrTestCase):
+
+    def test_common_name_and_sans(self):
+        self.make_csr("/CN=example.com", "subjectAltName=DNS:example.com,DNS:www.example.com")
+        self.assertEqual(self.assertParsedLikeUpstream(), set(["example.com", "www.example.com"]))
+
+    def test_common_name_only(self):
+        self.make_csr("/C=AU/O=Example/CN=example.com")
+        self.assertEqual(self.assertParsedLikeUpstream(), set(["example.com"]))
+
+    def test_sans_only(self):
+        self.make_csr("/O=Example", "subjectAltName=DNS:a.example.com,DNS:b.example.com")
+        self.assertEqual(self.assertParsedLikeUpstream(), set(["a.example.com", "b.example.com"]))
+
+    def test_critical_sans_with_other_name_types(self):
+        self.make_csr("/CN=*.example.com", "subjectAltName=critical,DNS:*.example.com,IP:10.0.0.1,email:root@example.com", "keyUsage=digitalSignature")
+        self.assertEqual(self.assertParsedLikeUpstream(), set(["*.example.com"]))
+
+    def test_many_sans_and_ec_key(self):
+        self.make_csr("/CN=d0.example.com", "subjectAltName=" + ",".join("DNS:d{0}.example.com".format(i) for i in range(120)), key=keys[1])
+        self.assertEqual(len(self.assertParsedLikeUpstream()), 120)
+
+    def test_new_certificate_request_header(self):
+        self.make_csr("/CN=example.com")
+        with open(self.path) as csr_file:
+            pem = csr_file.read().replace("CERTIFICATE REQUEST", "NEW CERTIFICATE REQUEST")
+        with open(self.path, "w") as csr_file:
+            csr_file.write(pem)
+        self.assertEqual(acme_tiny._parse_csr(self.path)[0], set(["example.com"]))
+
+    def test_generated_csrs(self):
+        rand = random.Random(29)
+        def label():
+            return "".join(rand.choice("abcdefghijklmnopqrstuvwxyz0123456789-") for _ in range(rand.randint(1, 20))).strip("-") or "x"
+        compared = 0
+        for i in range(60):
+            subject = "/C=AU/ST=Qld/O=Org {0}".format(i) if rand.random() < 0.3 else ""
+            if rand.random() < 0.85:
+                subject += "/CN=" + rand.choice(["*.", ""]) + label() + ".example.com"
+            if rand.random() < 0.2:
+                subject += "/emailAddress=root@example.com"
+            extensions = []
+            if rand.random() < 0.8:
+                names = []
+                for _ in range(rand.choice([1, 2, 5, 30, 120])):
+                    kind = rand.random()
+                    names.append("DNS:" + label() + ".example.org" if kind < 0.8 else "IP:10.0.0.{0}".format(rand.randint(1, 254)) if kind < 0.9 else "email:root@example.org")
+                extensions.append(("critical," if rand.random() < 0.2 else "") + "subjectAltName=" + ",".join(names))
+            if rand.random() < 0.3:
+                extensions.append("keyUsage=digitalSignature")
+            if not self.make_csr(subject or "/O=Example", *extensions, key=rand.choice(keys), extra=["-utf8"] if rand.random() < 0.2 else []):
+                continue
+            with self.subTest(subject=subject, extensions=extensions):
+                self.assertParsedLikeUpstream()
+                compared += 1
+        self.assertGreater(compared, 40)
+
+    def test_unreadable_csrs_raise_ioerror(self):
+        self.make_csr("/CN=example.com")
+        with open(self.path) as csr_file:
+            truncated = csr_file.read()[:200] + "\n-----END CERTIFICATE REQUEST-----\n"
+        with open(self.path, "w") as csr_file:
+            csr_file.write(truncated)
+        for path in (self.path, os.path.join(self.tmp, "missing.csr")):
+            self.assertRaises(IOError, acme_tiny._parse_csr, path)
+
+class FuzzTest(CsrTestCase):
+
+    def test_mutated_der_raises_only_fallback_errors(self):
+        self.make_csr("/CN=example.com", "subjectAltName=DNS:example.com,DNS:www.example.com")
+        der = upstream_parse_csr(self.path)[1]
+        rand = random.Random(30)
+        for _ in range(3000):
+            mutated = bytearray(der)
+            for _ in range(rand.randint(1, 4)):
+                mutated[rand.randrange(len(mutated))] = rand.randrange(256)
+            try:
+                acme_tiny._csr_domains(mutated)
+            except (IndexError, ValueError, TypeError): # what _parse_csr falls back to openssl on
+                pass
+
+    def test_mutated_pem_parses_or_raises_ioerror(self):
+        # malformed CSRs only have to fail cleanly or pass through unchanged, the CA rejects them at finalize
+        self.make_csr("/CN=example.com", "subjectAltName=DNS:example.com,DNS:www.example.com")
+        der = upstream_parse_csr(self.path)[1]
+        rand = random.Random(31)
+        for _ in range(300):
+            mutated = bytearray(der)
+            mutated[rand.randrange(len(mutated))] = rand.randrange(256)
+            with open(self.path, "wb") as csr_file:
+                csr_file.write(b"-----BEGIN CERTIFICATE REQUEST-----\n" + base64.encodebytes(bytes(mutated)) + b"-----END CERTIFICATE REQUEST-----\n")
+            try:
+                domains, csr_der = acme_tiny._parse_csr(self.path)
+            except (IOError, UnicodeDecodeError): # openssl rejects it, or prints non utf8 text, as upstream
+                continue
+            self.assertTrue(all(isinstance(domain, type(u"")) for domain in domains))
+            if csr_der != bytes(mutated): # went through the openssl fallback, which re-encodes it
+                self.assertEqual(csr_der, upstream_parse_csr(self.path)[1])
+
+if __name__ == "__main__":
+    unittest.main()
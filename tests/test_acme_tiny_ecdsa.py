@@ -0,0 +1,134 @@
+"""Check that the JWS signatures the patched acme_tiny.py sends with RSA and
+ECDSA account keys verify with openssl against the JWK it sends"""
+import base64, binascii, json, logging, os, shutil, subprocess, tempfile, unittest
+from unittest import mock
+
+import acme_tiny_tree
+from fake_acme import FakeACME, b64decode
+
+LOG = logging.getLogger("acme_tiny.test")
+LOG.addHandler(logging.NullHandler())
+LOG.propagate = False
+
+# DER SubjectPublicKeyInfo up to the uncompressed point, for rebuilding a public key from an EC JWK
+EC_SPKI_PREFIX = {
+    "P-256": "3059301306072a8648ce3d020106082a8648ce3d030107034200",
+    "P-384": "3076301006072a8648ce3d020106052b81040022036200",
+}
+
+def setUpModule():
+    global acme_tiny, build_dir
+    acme_tiny, build_dir = acme_tiny_tree.load_patched()
+
+def tearDownModule():
+    shutil.rmtree(build_dir, ignore_errors=True)
+
+def der_integer(value):
+    value = value.lstrip(b"\x00")
+    if not value or bytearray(value)[0] & 0x80:
+        value = b"\x00" + value
+    return b"\x02" + bytes(bytearray([len(value)])) + value
+
+def raw_to_der(raw):
+    """Convert a JWS r || s ECDSA signature back to the DER form openssl verifies"""
+    half = len(raw) // 2
+    body = der_integer(raw[:half]) + der_integer(raw[half:])
+    return b"\x30" + bytes(bytearray([len(body)])) + body
+
+def public_pem(jwk, account_key):
+    """Get the PEM public key for a JWK, rebuilt from the JWK for EC keys, and
+    from the account key for RSA keys after checking the JWK modulus"""
+    if jwk['kty'] == "EC":
+        der = binascii.unhexlify(EC_SPKI_PREFIX[jwk['crv']]) + b"\x04" + b64decode(jwk['x']) + b64decode(jwk['y'])
+        return "-----BEGIN PUBLIC KEY-----\n{0}-----END PUBLIC KEY-----\n".format(base64.encodebytes(der).decode('utf8'))
+    modulus = subprocess.check_output(["openssl", "rsa", "-in", account_key, "-noout", "-modulus"]).decode('utf8').strip().split("=")[1]
+    assert int(modulus, 16) == int(binascii.hexlify(b64decode(jwk['n'])), 16), "JWK modulus does not match the account key"
+    return subprocess.check_output(["openssl", "pkey", "-in", account_key, "-pubout"]).decode('utf8')
+
+class JwsSignatureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="acme-tiny-ecdsa-")
+        self.ca = FakeACME(self.tmp).start()
+        proxies = mock.patch.dict(os.environ, {"http_proxy": "", "HTTP_PROXY": ""})
+        proxies.start()
+        self.addCleanup(proxies.stop)
+
+    def tearDown(self):
+        self.ca.stop()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def signed_requests(self, key_type):
+        """Register an account with a key_type key and return the JWS bodies sent"""
+        account_key = acme_tiny_tree.make_key(os.path.join(self.tmp, key_type + ".key"), key_type)
+        sent, do_request = [], acme_tiny._do_request
+        def recording(session, url, data=None, **kwargs):
+            if data is not None:
+                sent.append(json.loads(data.decode('utf8')))
+            return do_request(session, url, data=data, **kwargs)
+        with mock.patch.object(acme_tiny, "_do_request", recording):
+            session = acme_tiny.get_session(account_key, log=LOG, directory_url=self.ca.directory_url, contact=["mailto:root@example.com"])
+        return session, sent, account_key
+
+    def assertVerifies(self, jws, public_pem, digest):
+        protected = json.loads(b64decode(jws['protected']).decode('utf8'))
+        signature = b64decode(jws['signature'])
+        if protected['alg'].startswith("ES"):
+            self.assertEqual(len(signature), {"ES256": 64, "ES384": 96}[protected['alg']])
+            signature = raw_to_der(signature)
+        paths = dict((name, os.path.join(self.tmp, name)) for name in ("pub.pem", "sig", "msg"))
+        for name, data in (("pub.pem", public_pem.encode('utf8')), ("sig", signature), ("msg", "{0}.{1}".format(jws['protected'], jws['payload']).encode('utf8'))):
+            with open(paths[name], "wb") as out:
+                out.write(data)
+        proc = subprocess.Popen(["openssl", "dgst", "-" + digest, "-verify", paths["pub.pem"], "-signature", paths["sig"], paths["msg"]],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        self.assertEqual(proc.returncode, 0, (out + err).decode('utf8'))
+
+    def check_key_type(self, key_type, alg, digest):
+        session, sent, account_key = self.signed_requests(key_type)
+        self.assertEqual(session['alg'], alg)
+        self.assertEqual(len(sent), 2) # newAccount (jwk) and contact update (kid)
+        jwk = json.loads(b64decode(sent[0]['protected']).decode('utf8'))['jwk']
+        self.assertEqual(jwk, session['jwk'])
+        public_key = public_pem(jwk, account_key)
+        for jws in sent:
+            self.assertVerifies(jws, public_key, digest)
+
+    def test_rs256(self):
+        self.check_key_type("rsa", "RS256", "sha256")
+
+    def test_es256(self):
+        self.check_key_type("P-256", "ES256", "sha256")
+
+    def test_es384(self):
+        self.check_key_type("P-384", "ES384", "sha384")
+
+    def test_many_es256_signatures(self):
+        # r and s are short or need a 0x00 sign byte in DER now and then, both must come out at 32 bytes
+        session, _, account_key = self.signed_requests("P-256")
+        public_key = public_pem(session['jwk'], account_key)
+        sent, do_request = [], acme_tiny._do_request
+        def recording(session, url, data=None, **kwargs):
+            sent.append(json.loads(data.decode('utf8')))
+            return do_request(session, url, data=data, **kwargs)
+        with mock.patch.object(acme_tiny, "_do_request", recording):
+            for _ in range(20):
+                acme_tiny._send_signed_request(session, session['kid'], None, "Error")
+        for jws in sent:
+            self.assertVerifies(jws, public_key, "sha256")
+
+class EcdsaDerToRawTest(unittest.TestCase):
+
+    def test_sign_byte_stripped_and_short_values_padded(self):
+        r, s = b"\x80" + b"\x11" * 31, b"\x22" * 30
+        der = raw_to_der(r + b"\x00\x00" + s)
+        self.assertEqual(bytearray(der)[3], 33) # r carries a 0x00 sign byte
+        self.assertEqual(acme_tiny._ecdsa_der_to_raw(bytearray(der), 32), r + b"\x00\x00" + s)
+
+    def test_p384_size(self):
+        raw = b"\x01" * 48 + b"\x7f" * 48
+        self.assertEqual(acme_tiny._ecdsa_der_to_raw(bytearray(raw_to_der(raw)), 48), raw)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,165 @@
+"""Check that debian/webmin.postinst installs the module archives queued by
+webmin-* plugin packages with the patched install-module.pl, in dependency
+order, on both the trigger run and on the configure run dpkg retries a
+failed trigger with. Webmin itself is replaced by a stub that records the
+archives it is asked to install."""
+import io, os, shutil, subprocess, tarfile, tempfile, unittest
+
+from acme_tiny_tree import ROOT
+
+PATCH = "install-module-multiple-archives.diff"
+
+STUB_WEBMINCORE = r"""package WebminCore;
+sub import
+{
+*main::init_config = sub { };
+*main::foreign_require = sub { };
+}
+
+package webmin;
+sub get_newmodule_users { return undef; }
+sub install_webmin_module
+{
+my ($file) = @_;
+return "<b>stub failure</b>" if ($ENV{'STUB_FAIL'});
+open(LOG, ">>$ENV{'STUB_LOG'}");
+print LOG "$file\n";
+close(LOG);
+(my $mod = $file) =~ s/^.*\/|\..*$//g;
+return [ [ $mod ], [ "/stub/$mod" ], [ 1 ] ];
+}
+1;
+"""
+
+def build_install_module(dest):
+    """Copy install-module.pl into dest with the multiple archives patch applied,
+    whether or not quilt has already applied it to this tree"""
+    os.makedirs(os.path.join(dest, "webmin_core"))
+    shutil.copy(os.path.join(ROOT, "webmin_core", "install-module.pl"), os.path.join(dest, "webmin_core"))
+    applied_path = os.path.join(ROOT, ".pc", "applied-patches")
+    applied = []
+    if os.path.exists(applied_path):
+        with open(applied_path) as applied_file:
+            applied = applied_file.read().split()
+    if PATCH not in applied:
+        with open(os.path.join(ROOT, "debian", "patches", PATCH)) as patch_file:
+            subprocess.check_call(["patch", "-s", "-p1", "--no-backup-if-mismatch"], cwd=dest, stdin=patch_file)
+    return os.path.join(dest, "webmin_core", "install-module.pl")
+
+class StubWebminTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="webmin-postinst-")
+        path = lambda *names: os.path.join(self.tmp, *names)
+        self.root, self.config, self.varlib, bin_dir = path("root"), path("config"), path("varlib"), path("bin")
+        for directory in (self.root, self.config, self.varlib, bin_dir, path("var")):
+            os.makedirs(directory)
+        shutil.copy(build_install_module(path("build")), self.root)
+        with open(os.path.join(self.root, "WebminCore.pm"), "w") as stub:
+            stub.write(STUB_WEBMINCORE)
+        for script, body in ((os.path.join(self.root, "setup.sh"), ""), (os.path.join(bin_dir, "systemctl"), "")):
+            with open(script, "w") as out:
+                out.write("#!/bin/sh\n" + body)
+            os.chmod(script, 0o755)
+        with open(os.path.join(self.config, "miniserv.conf"), "w") as conf:
+            conf.write("root={0}\nsudo=1\n".format(self.root))
+        with open(os.path.join(self.config, "var-path"), "w") as var_path:
+            var_path.write(path("var") + "\n")
+        with open(os.path.join(ROOT, "debian", "webmin.postinst")) as postinst:
+            script = postinst.read()
+        for old, new in (("/usr/share/webmin", self.root), ("/etc/webmin", self.config), ("/var/lib/webmin", self.varlib),
+                         ("/tmp/.webmin", self.tmp), ("/var/lock/subsys", self.tmp), ("/etc/systemd/system", self.tmp)):
+            script = script.replace(old, new)
+        self.postinst = path("webmin.postinst")
+        with open(self.postinst, "w") as out:
+            out.write(script)
+        self.log = path("installed")
+        self.env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ["PATH"], STUB_LOG=self.log)
+        self.queue = os.path.join(self.varlib, "install-queue")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def make_archive(self, name, depends=""):
+        archive = os.path.join(self.tmp, name + ".wbm.gz")
+        with tarfile.open(archive, "w:gz") as tar:
+            info = "desc={0}\ndepends={1}\n".format(name, depends).encode('utf8')
+            member = tarfile.TarInfo(name + "/module.info")
+            member.size = len(info)
+            tar.addfile(member, io.BytesIO(info))
+        return archive
+
+    def installed(self):
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as log:
+            return log.read().split()
+
+class PostinstTest(StubWebminTestCase):
+
+    def queue_archives(self):
+        """Queue a module that depends on one queued after it, and an archive
+        whose package has since been removed"""
+        archives = [self.make_archive("a", "1.5 b c"), os.path.join(self.tmp, "removed.wbm.gz"), self.make_archive("b")]
+        with open(self.queue, "w") as queue:
+            queue.write("".join(archive + "\n" for archive in archives))
+        return archives
+
+    def run_postinst(self, action, **env):
+        return subprocess.run(["sh", self.postinst, action], env=dict(self.env, **env),
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+
+    def test_trigger_installs_queue_in_dependency_order(self):
+        a, _, b = self.queue_archives()
+        proc = self.run_postinst("triggered")
+        self.assertEqual(proc.returncode, 0, proc.stdout)
+        self.assertEqual(self.installed(), [b, a])
+        self.assertFalse(os.path.exists(self.queue))
+
+    def test_failed_trigger_keeps_queue_for_configure(self):
+        a, _, b = self.queue_archives()
+        proc = self.run_postinst("triggered", STUB_FAIL="1")
+        self.assertEqual(proc.returncode, 1, proc.stdout)
+        self.assertIn("stub failure", proc.stdout)
+        self.assertTrue(os.path.exists(self.queue))
+        # dpkg retries a failed trigger run with configure
+        proc = self.run_postinst("configure")
+        self.assertEqual(proc.returncode, 0, proc.stdout)
+        self.assertEqual(self.installed(), [b, a])
+        self.assertFalse(os.path.exists(self.queue))
+
+    def test_configure_without_queue(self):
+        proc = self.run_postinst("configure")
+        self.assertEqual(proc.returncode, 0, proc.stdout)
+        self.assertEqual(self.installed(), [])
+
+class InstallModuleTest(StubWebminTestCase):
+    """The patched install-module.pl still installs a single file as before"""
+
+    def install_module(self, *args, **env):
+        return subprocess.run(["perl", os.path.join(self.root, "install-module.pl")] + list(args), cwd=self.tmp, env=dict(self.env, **env),
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+
+    def test_single_file_with_config_dir(self):
+        self.make_archive("a", "b")
+        proc = self.install_module("a.wbm.gz", self.config)
+        self.assertEqual(proc.returncode, 0, proc.stdout)
+        self.assertIn("Installed a in /stub/a", proc.stdout)
+        self.assertEqual(self.installed(), [os.path.join(self.tmp, "a.wbm.gz")])
+
+    def test_failure_exits_non_zero(self):
+        self.make_archive("a")
+        proc = self.install_module("a.wbm.gz", self.config, STUB_FAIL="1")
+        self.assertEqual(proc.returncode, 1, proc.stdout)
+        self.assertIn("Install failed : stub failure", proc.stdout)
+
+    def test_missing_config_root(self):
+        self.make_archive("a")
+        with open(os.path.join(self.config, "miniserv.conf"), "w") as conf:
+            conf.write("root={0}\n".format(os.path.join(self.tmp, "missing")))
+        proc = self.install_module("a.wbm.gz", self.config)
+        self.assertNotEqual(proc.returncode, 0)
+        self.assertIn("does not exist", proc.stdout)
+
+if __name__ == "__main__":
+    unittest.main()